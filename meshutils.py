@@ -15,22 +15,10 @@ def mesh_from_collection(collection, name=None):
         bm.verts.ensure_lookup_table()
         last_idx = len(bm.verts)
 
-        other_bm = bmesh.new()
-        other_bm.from_object(ob, bpy.context.evaluated_depsgraph_get())
-        other_bm.transform(ob.matrix_world)
-        other_bm.verts.ensure_lookup_table()
-        other_bm.edges.ensure_lookup_table()
-        other_bm.faces.ensure_lookup_table()
-
-        for vert in other_bm.verts:
-            bm.verts.new(vert.co)
+        # from_object appends to the existing geometry, then only the new vertices are transformed
+        bm.from_object(ob, bpy.context.evaluated_depsgraph_get())
         bm.verts.ensure_lookup_table()
-
-        for edge in other_bm.edges:
-            bm.edges.new([bm.verts[vert.index + last_idx] for vert in edge.verts])
-
-        for face in other_bm.faces:
-            bm.faces.new([bm.verts[vert.index + last_idx] for vert in face.verts])
+        bmesh.ops.transform(bm, matrix=ob.matrix_world, verts=bm.verts[last_idx:])
 
     new_mesh = bpy.data.meshes.new(name)
     bm.to_mesh(new_mesh)
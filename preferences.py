@@ -1,8 +1,20 @@
 import os
 import sys
+import importlib.util
+import tempfile
+from functools import lru_cache
 import bpy
 
 
+@lru_cache(maxsize=None)
+def has_embree():
+    """
+    Whether trimesh can cast rays with embree: embreex in recent trimesh releases, pyembree in older ones.
+    Cached, as the preferences are drawn often. Cleared when the modules path changes
+    """
+    return any(importlib.util.find_spec(name) for name in ('embreex', 'pyembree'))
+
+
 class BrignetPrefs(bpy.types.AddonPreferences):
     bl_idname = __package__
 
@@ -60,6 +72,7 @@ class BrignetPrefs(bpy.types.AddonPreferences):
 
     def update_modules(self, context):
         self.append_modules()
+        has_embree.cache_clear()
 
     def update_rignet(self, context):
         self.append_rignet()
@@ -86,6 +99,13 @@ class BrignetPrefs(bpy.types.AddonPreferences):
         # default=os.path.join(os.path.join(os.path.dirname(__file__)), 'RigNet', 'checkpoints')
     )
 
+    cache_path: bpy.props.StringProperty(
+        name='Cache path',
+        description='Path where voxelized meshes and their geodesic distances are cached',
+        subtype='DIR_PATH',
+        default=os.path.join(tempfile.gettempdir(), 'brignet_cache')
+    )
+
     def draw(self, context):
         layout = self.layout
         column = layout.column()
@@ -97,6 +117,12 @@ class BrignetPrefs(bpy.types.AddonPreferences):
         # row.prop(self, 'modules_path', text='Modules Path')
         row = col.row()
         row.prop(self, 'rignet_path', text='RigNet Path')
+        row = col.row()
+        row.prop(self, 'cache_path', text='Cache Path')
+        if not has_embree():
+            row = col.row()
+            row.label(text="Install embreex (pyembree for older trimesh) in the RigNet environment "
+                           "for faster skinning", icon='INFO')
         # row = col.row()
         # row.prop(self, 'model_path', text='Model Path')
 
@@ -1,11 +1,22 @@
 import os
+import re
 import sys
+import shutil
+import hashlib
 import subprocess
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 import trimesh
 import numpy as np
 import open3d as o3d
-import itertools as it
+from scipy.spatial import cKDTree
+
+try:
+    import numba
+except ImportError:
+    # meanshift falls back to the RigNet implementation
+    numba = None
 
 import torch
 from torch_geometric.data import Data
@@ -17,13 +28,13 @@ from utils.tree_utils import TreeNode
 from utils.io_utils import assemble_skel_skin
 from utils.vis_utils import draw_shifted_pts, show_obj_skel, show_mesh_vox
 from utils.cluster_utils import meanshift_cluster, nms_meanshift
-from utils.mst_utils import increase_cost_for_outside_bone, primMST_symmetry, loadSkel_recur, inside_check, flip
+from utils.mst_utils import increase_cost_for_outside_bone, loadSkel_recur, flip
 
 from geometric_proc.common_ops import get_bones, calc_surface_geodesic
-from geometric_proc.compute_volumetric_geodesic import pts2line, calc_pts2bone_visible_mat
+from geometric_proc.compute_volumetric_geodesic import pts2line
 
 from gen_dataset import get_tpl_edges, get_geo_edges
-from mst_generate import sample_on_bone, getInitId
+from mst_generate import getInitId
 from run_skinning import post_filter
 
 from models.GCN import JOINTNET_MASKNET_MEANSHIFT as JOINTNET
@@ -37,8 +48,24 @@ from mathutils import Matrix
 import tempfile
 from .rigutils import ArmatureGenerator
 
+if tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 1) and not sys.platform.startswith("win") \
+        and not torch.cuda.is_initialized():
+    # growable allocator segments, as mesh sizes change between predictions. Older torch versions reject the option,
+    # and it only applies if set before the first cuda allocation
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 MESH_NORMALIZED = None
+# bytes, a geodesic matrix takes 8*V^2
+CACHE_SIZE = 4 * 1024 ** 3
+# voxelization and geodesic matrix of a mesh, named by its hash
+CACHE_FILE_PATTERN = re.compile(r'^[0-9a-f]{32}\.(binvox|geodesic\.npy)(\.tmp)?$')
+# loaded networks, kept when this module is reloaded
+NETWORKS = globals().get('NETWORKS', {})
+# captured skinning network, see run_skinning_net
+SKIN_GRAPHS = globals().get('SKIN_GRAPHS', {})
+# members of the input data read by the skinning network
+SKIN_INPUTS = ('pos', 'x', 'skin_input', 'tpl_edge_index', 'geo_edge_index', 'batch')
 
 
 def normalize_obj(mesh_v):
@@ -55,11 +82,70 @@ def normalize_obj(mesh_v):
     return mesh_v, pivot, scale
 
 
-def create_single_data(mesh_obj):
+def prune_cache(cache_dir, max_bytes=CACHE_SIZE):
     """
-    create input data for the network. The data is wrapped by Data structure in pytorch-geometric library
-    :param mesh_filaname: name of the input mesh
-    :return: wrapped data, voxelized mesh, and geodesic distance matrix of all vertices
+    Remove the least recently used entries from the cache folder, the most recent entry is always kept.
+    Files that are not cache entries are left alone, as the folder is chosen by the user
+    :param cache_dir: cache folder, files of the same entry share the mesh hash before the first dot
+    :param max_bytes: total size of the entries to keep
+    """
+    cache_files = [filename for filename in os.listdir(cache_dir) if CACHE_FILE_PATTERN.match(filename)
+                   and os.path.isfile(os.path.join(cache_dir, filename))]
+
+    last_used = {}
+    entry_size = {}
+    for filename in cache_files:
+        entry = filename.split('.')[0]
+        stat = os.stat(os.path.join(cache_dir, filename))
+        last_used[entry] = max(stat.st_mtime, last_used.get(entry, stat.st_mtime))
+        entry_size[entry] = entry_size.get(entry, 0) + stat.st_size
+
+    stale = set()
+    total_size = 0
+    for i, entry in enumerate(sorted(last_used, key=last_used.get, reverse=True)):
+        total_size += entry_size[entry]
+        if i > 0 and total_size > max_bytes:
+            stale.add(entry)
+
+    for filename in cache_files:
+        if filename.split('.')[0] in stale:
+            os.unlink(os.path.join(cache_dir, filename))
+
+
+def binvox_executable(rignet_path):
+    """
+    Path of the binvox executable shipped with RigNet
+    :param rignet_path: RigNet folder
+    :return: path of binvox, or binvox.exe on windows
+    """
+    binvox_exe = os.path.join(rignet_path, "binvox")
+
+    if sys.platform.startswith("win"):
+        binvox_exe += ".exe"
+    return binvox_exe
+
+
+def check_paths(rignet_path, model_dir):
+    """
+    Check that binvox and the network checkpoints exist, so that wrong preferences fail before the mesh is modified
+    :param rignet_path: RigNet folder, where binvox is found
+    :param model_dir: folder of the RigNet checkpoints
+    """
+    if not os.path.isfile(binvox_executable(rignet_path)):
+        raise FileNotFoundError("binvox executable not found in {0}, "
+                                "please check RigNet path in the addon preferences".format(rignet_path))
+
+    for net_name in ('gcn_meanshift', 'rootnet', 'bonenet', 'skinnet'):
+        checkpoint = os.path.join(model_dir, net_name, 'model_best.pth.tar')
+        if not os.path.isfile(checkpoint):
+            raise FileNotFoundError("{0} not found, please check model path in the addon preferences".format(checkpoint))
+
+
+def extract_mesh(mesh_obj):
+    """
+    Triangulate the mesh object, apply its modifiers and read its geometry. Uses bpy, must run in the main thread
+    :param mesh_obj: input mesh object
+    :return: V*3 vertices rotated as RigNet expects, and F*3 triangles
     """
 
     # triangulate first
@@ -73,23 +159,37 @@ def create_single_data(mesh_obj):
         mesh_obj.modifiers.remove(mod)
 
     bm.to_mesh(mesh_obj.data)
+    bm.free()
     bpy.context.evaluated_depsgraph_get()
 
-    # rotate -90 deg on X axis
-    mat = Matrix(((1.0, 0.0, 0.0, 0.0),
-                  (0.0, 0.0, 1.0, 0.0),
-                  (0.0, -1.0, 0, 0.0),
-                  (0.0, 0.0, 0.0, 1.0)))
+    # read vertices and triangles in bulk
+    mesh_data = mesh_obj.data
+    mesh_v = np.empty(len(mesh_data.vertices) * 3, dtype=np.float32)
+    mesh_data.vertices.foreach_get("co", mesh_v)
+    mesh_data.calc_loop_triangles()
+    mesh_f = np.empty(len(mesh_data.loop_triangles) * 3, dtype=np.int32)
+    mesh_data.loop_triangles.foreach_get("vertices", mesh_f)
 
-    bmesh.ops.transform(bm, matrix=mat, verts=bm.verts[:])
-    bm.verts.ensure_lookup_table()
-    bm.faces.ensure_lookup_table()
+    # rotate -90 deg on X axis
+    mat = np.array(((1.0, 0.0, 0.0),
+                    (0.0, 0.0, 1.0),
+                    (0.0, -1.0, 0.0)))
 
-    mesh_v = np.asarray([list(v.co) for v in bm.verts])
-    mesh_f = np.asarray([[v.index for v in f.verts] for f in bm.faces])
+    mesh_v = mesh_v.reshape(-1, 3) @ mat.T
+    mesh_f = mesh_f.reshape(-1, 3)
+    return mesh_v, mesh_f
 
-    bm.free()
 
+def create_single_data(mesh_v, mesh_f, rignet_path, cache_dir):
+    """
+    create input data for the network. The data is wrapped by Data structure in pytorch-geometric library.
+    Doesn't use bpy, so that it can run in a background thread
+    :param mesh_v: vertices of the input mesh
+    :param mesh_f: triangles of the input mesh
+    :param rignet_path: RigNet folder, where binvox is found. Checked by check_paths
+    :param cache_dir: folder of the voxelization and geodesic distance cache
+    :return: wrapped data, voxelized mesh, and geodesic distance matrix of all vertices
+    """
     mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(mesh_v), o3d.open3d.utility.Vector3iVector(mesh_f))
     mesh.compute_vertex_normals()
     mesh.compute_triangle_normals()
@@ -105,6 +205,11 @@ def create_single_data(mesh_obj):
     global MESH_NORMALIZED
     MESH_NORMALIZED = mesh_normalized
 
+    # voxelization and geodesic distances are cached by mesh content.
+    # mesh_v shares memory with the vertices of mesh, so this is the mesh used for geodesic distances too
+    os.makedirs(cache_dir, exist_ok=True)
+    mesh_hash = hashlib.blake2b(mesh_v.tobytes() + mesh_f.tobytes(), digest_size=16).hexdigest()
+
     # vertices
     v = np.concatenate((mesh_v, mesh_vn), axis=1)
     v = torch.from_numpy(v).float()
@@ -114,8 +219,27 @@ def create_single_data(mesh_obj):
     tpl_e = torch.from_numpy(tpl_e).long()
     tpl_e, _ = add_self_loops(tpl_e, num_nodes=v.size(0))
     # surface geodesic distance matrix
-    print("     calculating surface geodesic matrix.")
-    surface_geodesic = calc_surface_geodesic(mesh)
+    geodesic_filename = os.path.join(cache_dir, mesh_hash + '.geodesic.npy')
+    surface_geodesic = None
+    if os.path.isfile(geodesic_filename):
+        print("     loading cached surface geodesic matrix.")
+        try:
+            surface_geodesic = np.load(geodesic_filename)
+            os.utime(geodesic_filename)
+        except (OSError, ValueError, EOFError) as e:
+            print("     discarding unreadable cache entry: {0}".format(e))
+            os.unlink(geodesic_filename)
+    if surface_geodesic is None:
+        print("     calculating surface geodesic matrix.")
+        surface_geodesic = calc_surface_geodesic(mesh)
+        if surface_geodesic.nbytes <= CACHE_SIZE:
+            # write under a temporary name, so that an interrupted write doesn't leave a truncated entry
+            with open(geodesic_filename + '.tmp', 'wb') as fgeo:
+                np.save(fgeo, surface_geodesic)
+            os.replace(geodesic_filename + '.tmp', geodesic_filename)
+            prune_cache(cache_dir)
+        else:
+            print("     surface geodesic matrix is larger than the cache, not cached.")
     # geodesic edges
     print("     gathering geodesic edges.")
     geo_e = get_geo_edges(surface_geodesic, mesh_v).T
@@ -124,33 +248,217 @@ def create_single_data(mesh_obj):
     # batch
     batch = torch.zeros(len(v), dtype=torch.long)
     # voxel
-    fo_normalized = tempfile.NamedTemporaryFile(suffix='_normalized.obj')
-    fo_normalized.close()
+    vox_filename = os.path.join(cache_dir, mesh_hash + '.binvox')
 
-    o3d.io.write_triangle_mesh(fo_normalized.name, mesh_normalized)
+    if os.path.isfile(vox_filename):
+        os.utime(vox_filename)
+    else:
+        fo_normalized = tempfile.NamedTemporaryFile(suffix='_normalized.obj')
+        fo_normalized.close()
 
-    # TODO: we might cache the .binvox file somewhere, as in the RigNet quickstart example
-    rignet_path = bpy.context.preferences.addons[__package__].preferences.rignet_path
-    binvox_exe = os.path.join(rignet_path, "binvox")
+        o3d.io.write_triangle_mesh(fo_normalized.name, mesh_normalized)
 
-    if sys.platform.startswith("win"):
-        binvox_exe += ".exe"
-
-    if not os.path.isfile(binvox_exe):
+        subprocess.call([binvox_executable(rignet_path), "-d", "88", fo_normalized.name])
+        shutil.move(os.path.splitext(fo_normalized.name)[0] + '.binvox', vox_filename + '.tmp')
+        os.replace(vox_filename + '.tmp', vox_filename)
         os.unlink(fo_normalized.name)
-        clear()
-        raise FileNotFoundError("binvox executable not found in {0}, please check RigNet path in the addon preferences")
+        prune_cache(cache_dir)
 
-    subprocess.call([binvox_exe, "-d", "88", fo_normalized.name])
-    with open(os.path.splitext(fo_normalized.name)[0] + '.binvox', 'rb') as fvox:
+    with open(vox_filename, 'rb') as fvox:
         vox = binvox_rw.read_as_3d_array(fvox)
 
-    os.unlink(fo_normalized.name)
-
     data = Data(x=v[:, 3:6], pos=v[:, 0:3], tpl_edge_index=tpl_e, geo_edge_index=geo_e, batch=batch)
+    if device.type == 'cuda':
+        # page-locked memory allows asynchronous copies to the device
+        data = data.pin_memory()
     return data, vox, surface_geodesic, translation_normalize, scale_normalize
 
 
+@contextmanager
+def network_inference():
+    """
+    Context for running the networks: no autograd, and float16 autocast when running on cuda.
+    Falls back to no_grad and torch.cuda.amp on torch versions older than 1.10
+    """
+    grad_mode = torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()
+    if hasattr(torch, 'autocast'):
+        # the autocast weight cache is not allowed when capturing CUDA graphs
+        autocast = torch.autocast('cuda', dtype=torch.float16, enabled=device.type == 'cuda', cache_enabled=False)
+    elif hasattr(torch.cuda, 'amp'):
+        autocast = torch.cuda.amp.autocast(enabled=device.type == 'cuda')
+    else:
+        autocast = nullcontext()
+
+    with grad_mode, autocast:
+        yield
+
+
+def voxel_to_device(vox):
+    """
+    Upload voxelized mesh to the device, to be used by inside_check_device
+    :param vox: voxelized mesh
+    :return: voxel grid, translation, scale and resolution of the voxelization
+    """
+    vox_data = torch.from_numpy(np.ascontiguousarray(vox.data)).to(device)
+    # float64, as inside_check computes the voxel coordinates in double precision
+    translate = torch.tensor(vox.translate, dtype=torch.float64, device=device)
+    return vox_data, translate, vox.scale, vox.dims[0]
+
+
+def inside_check_device(pts, vox_grid):
+    """
+    Check where points are inside or outside the mesh based on its voxelization, same as inside_check
+    :param pts: N*3 tensor of points to be checked
+    :param vox_grid: voxelized mesh, as returned by voxel_to_device
+    :return: boolean mask of the internal points
+    """
+    vox_data, translate, scale, dim = vox_grid
+    vc = torch.round((pts.double() - translate) / scale * dim).long()
+    in_grid = ((vc >= 0) & (vc < dim)).all(dim=1)
+    vc = vc.clamp(0, dim - 1)
+    return in_grid & vox_data[vc[:, 0], vc[:, 1], vc[:, 2]]
+
+
+def calc_density(pts, bandwidth, symmetric=False):
+    """
+    Density of each point as the sum of (bandwidth^2 - squared distance) over its neighbors within bandwidth
+    :param pts: N*3 points
+    :param bandwidth: bandwidth used in meanshift
+    :param symmetric: also count the reflection of the points on the x axis as neighbors.
+                      Reflected points have the same density as their original
+    :return: density at each point
+    """
+    tree = cKDTree(pts)
+    near_pairs = tree.query_pairs(bandwidth, output_type='ndarray')
+    near_dist = np.sum((pts[near_pairs[:, 0]] - pts[near_pairs[:, 1]]) ** 2, axis=1)
+    near_density = np.maximum(bandwidth ** 2 - near_dist, 0.0)
+    # each point is its own neighbor at distance 0
+    density = np.full(len(pts), bandwidth ** 2)
+    density += np.bincount(near_pairs[:, 0], weights=near_density, minlength=len(pts))
+    density += np.bincount(near_pairs[:, 1], weights=near_density, minlength=len(pts))
+
+    if symmetric:
+        pts_reflect = pts * np.array([[-1, 1, 1]])
+        mirror_pairs = tree.sparse_distance_matrix(cKDTree(pts_reflect), bandwidth, output_type='ndarray')
+        mirror_dist = np.sum((pts[mirror_pairs['i']] - pts_reflect[mirror_pairs['j']]) ** 2, axis=1)
+        mirror_density = np.maximum(bandwidth ** 2 - mirror_dist, 0.0)
+        density += np.bincount(mirror_pairs['i'], weights=mirror_density, minlength=len(pts))
+    return density
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def meanshift_step(pts, weights, bandwidth, symmetric):
+        """
+        One step of weighted meanshift with flat kernel (bandwidth^2 - squared distance)
+        :param pts: N*3 points
+        :param weights: N weights of the points
+        :param bandwidth: bandwidth
+        :param symmetric: the reflection of the points on the x axis are neighbors too
+        :return: shifted points
+        """
+        bw2 = bandwidth * bandwidth
+        num_pts = len(pts)
+        num_neighbors = 2 * num_pts if symmetric else num_pts
+        pts_out = np.empty_like(pts)
+        for i in numba.prange(num_pts):
+            x, y, z = 0.0, 0.0, 0.0
+            w_sum = 0.0
+            for n in range(num_neighbors):
+                j = n % num_pts
+                px = -pts[j, 0] if n >= num_pts else pts[j, 0]
+                dx = px - pts[i, 0]
+                dy = pts[j, 1] - pts[i, 1]
+                dz = pts[j, 2] - pts[i, 2]
+                w = bw2 - (dx * dx + dy * dy + dz * dz)
+                if w > 0.0:
+                    w *= weights[j]
+                    x += w * px
+                    y += w * pts[j, 1]
+                    z += w * pts[j, 2]
+                    w_sum += w
+            # same regularization as meanshift_cluster
+            w_sum += 1e-10
+            pts_out[i, 0] = x / w_sum
+            pts_out[i, 1] = y / w_sum
+            pts_out[i, 2] = z / w_sum
+        return pts_out
+
+    @numba.njit(cache=True)
+    def nms_meanshift_jit(pts, density, bandwidth):
+        """
+        NMS to extract modes after meanshift, keeps the densest point of each neighborhood
+        :param pts: N*3 points
+        :param density: density at each point
+        :param bandwidth: neighbor region for NMS
+        :return: extracted clusters
+        """
+        bw2 = bandwidth * bandwidth
+        unique = np.ones(len(pts), dtype=np.bool_)
+        for i in np.argsort(density)[::-1]:
+            if not unique[i]:
+                continue
+            for j in range(len(pts)):
+                dx = pts[j, 0] - pts[i, 0]
+                dy = pts[j, 1] - pts[i, 1]
+                dz = pts[j, 2] - pts[i, 2]
+                if j != i and dx * dx + dy * dy + dz * dz <= bw2:
+                    unique[j] = False
+        return pts[unique]
+
+    # compile at import, rather than on the first prediction
+    meanshift_step(np.zeros((2, 3)), np.ones(2), 1.0, True)
+    nms_meanshift_jit(np.zeros((2, 3)), np.ones(2), 1.0)
+
+
+def run_meanshift(pts, bandwidth, weights, max_iter=20, symmetric=False):
+    """
+    Meanshift clustering, jit compiled when numba is available
+    :param pts: N*3 points
+    :param bandwidth: bandwidth
+    :param weights: N*1 weights per point, indicating its importance in the clustering
+    :param max_iter: maximum number of iterations
+    :param symmetric: cluster the points together with their reflection on the x axis.
+                      Reflected points move as the reflection of their original, so only the originals are returned
+    :return: points after clustering
+    """
+    if numba is None:
+        if symmetric:
+            pts_reflect = pts * np.array([[-1, 1, 1]])
+            pts = np.concatenate((pts, pts_reflect), axis=0)
+            return meanshift_cluster(pts, bandwidth, np.tile(weights, (2, 1)), max_iter=max_iter)[:len(pts_reflect)]
+        return meanshift_cluster(pts, bandwidth, weights, max_iter=max_iter)
+
+    pts = np.ascontiguousarray(pts, dtype=np.float64)
+    weights = np.ascontiguousarray(weights, dtype=np.float64).ravel()
+    for _ in range(max_iter - 1):
+        pts_out = meanshift_step(pts, weights, bandwidth, symmetric)
+        # same convergence test as meanshift_cluster: norm of the shift over all points
+        diff = np.sqrt(np.sum((pts_out - pts) ** 2))
+        if symmetric:
+            # the reflected points move as much as their originals, as in the doubled set
+            diff *= np.sqrt(2)
+        pts = pts_out
+        if diff <= 1e-3:
+            break
+    return pts
+
+
+def run_nms(pts, density, bandwidth):
+    """
+    NMS to extract modes after meanshift, jit compiled when numba is available
+    :param pts: N*3 points
+    :param density: density at each point
+    :param bandwidth: bandwidth used in meanshift
+    :return: extracted clusters
+    """
+    if numba is None:
+        return nms_meanshift(pts, density, bandwidth)
+
+    pts = np.ascontiguousarray(pts, dtype=np.float64)
+    return nms_meanshift_jit(pts, np.ascontiguousarray(density, dtype=np.float64), bandwidth)
+
+
 def predict_joints(input_data, vox, joint_pred_net, threshold, bandwidth=None, mesh_filename=None):
     """
     Predict joints
@@ -162,51 +470,52 @@ def predict_joints(input_data, vox, joint_pred_net, threshold, bandwidth=None, m
     :param mesh_filename: mesh filename for visualization
     :return: wrapped data with predicted joints, pair-wise bone representation added.
     """
-    data_displacement, _, attn_pred, bandwidth_pred = joint_pred_net(input_data)
-    y_pred = data_displacement + input_data.pos
-    y_pred_np = y_pred.data.cpu().numpy()
-    attn_pred_np = attn_pred.data.cpu().numpy()
-    y_pred_np, index_inside = inside_check(y_pred_np, vox)
-    attn_pred_np = attn_pred_np[index_inside, :]
-    y_pred_np = y_pred_np[attn_pred_np.squeeze() > 1e-3]
-    attn_pred_np = attn_pred_np[attn_pred_np.squeeze() > 1e-3]
-
-    # symmetrize points by reflecting
-    y_pred_np_reflect = y_pred_np * np.array([[-1, 1, 1]])
-    y_pred_np = np.concatenate((y_pred_np, y_pred_np_reflect), axis=0)
-    attn_pred_np = np.tile(attn_pred_np, (2, 1))
+    vox_grid = voxel_to_device(vox)
+    with network_inference():
+        data_displacement, _, attn_pred, bandwidth_pred = joint_pred_net(input_data)
+    y_pred = data_displacement.float() + input_data.pos
+    attn_pred = attn_pred.float()
+    # filter on device, only the remaining points are moved to cpu
+    keep = inside_check_device(y_pred, vox_grid) & (attn_pred[:, 0] > 1e-3)
+    y_pred_np = y_pred[keep].data.cpu().numpy()
+    attn_pred_np = attn_pred[keep].data.cpu().numpy()
 
     # img = draw_shifted_pts(mesh_filename, y_pred_np, weights=attn_pred_np)
     if not bandwidth:
         bandwidth = bandwidth_pred.item()
-    y_pred_np = meanshift_cluster(y_pred_np, bandwidth, attn_pred_np, max_iter=40)
+    # points are symmetrized by reflecting. The reflected points are accounted for in clustering and density,
+    # but only added back after, as they mirror their originals
+    y_pred_np = run_meanshift(y_pred_np, bandwidth, attn_pred_np, max_iter=40, symmetric=True)
+    density = calc_density(y_pred_np, bandwidth, symmetric=True)
     # img = draw_shifted_pts(mesh_filename, y_pred_np, weights=attn_pred_np)
 
-    Y_dist = np.sum(((y_pred_np[np.newaxis, ...] - y_pred_np[:, np.newaxis, :]) ** 2), axis=2)
-    density = np.maximum(bandwidth ** 2 - Y_dist, np.zeros(Y_dist.shape))
-    density = np.sum(density, axis=0)
-    density_sum = np.sum(density)
-    y_pred_np = y_pred_np[density / density_sum > threshold]
-    attn_pred_np = attn_pred_np[density / density_sum > threshold][:, 0]
-    density = density[density / density_sum > threshold]
+    # reflected points share the density of their originals: filter once, then add the reflection of the remaining
+    density_sum = 2 * np.sum(density)
+    keep = density / density_sum > threshold
+    y_pred_np = y_pred_np[keep]
+    y_pred_np = np.concatenate((y_pred_np, y_pred_np * np.array([[-1, 1, 1]])), axis=0)
+    attn_pred_np = np.tile(attn_pred_np[keep, 0], 2)
+    density = np.tile(density[keep], 2)
 
     # img = draw_shifted_pts(mesh_filename, y_pred_np, weights=attn_pred_np)
-    pred_joints = nms_meanshift(y_pred_np, density, bandwidth)
+    pred_joints = run_nms(y_pred_np, density, bandwidth)
     pred_joints, _ = flip(pred_joints)
     # img = draw_shifted_pts(mesh_filename, pred_joints)
 
     # prepare and add new data members
-    pairs = list(it.combinations(range(pred_joints.shape[0]), 2))
-    pair_attr = []
-    for pr in pairs:
-        dist = np.linalg.norm(pred_joints[pr[0]] - pred_joints[pr[1]])
-        bone_samples = sample_on_bone(pred_joints[pr[0]], pred_joints[pr[1]])
-        bone_samples_inside, _ = inside_check(bone_samples, vox)
-        outside_proportion = len(bone_samples_inside) / (len(bone_samples) + 1e-10)
-        attr = np.array([dist, outside_proportion, 1])
-        pair_attr.append(attr)
-    pairs = np.array(pairs)
-    pair_attr = np.array(pair_attr)
+    pairs = np.stack(np.triu_indices(len(pred_joints), 1), axis=1)
+    bone_ray = pred_joints[pairs[:, 1]] - pred_joints[pairs[:, 0]]
+    dist = np.linalg.norm(bone_ray, axis=1)
+    # sample all bones at once, with the same steps as sample_on_bone, and check them in a single call
+    num_step = np.round(dist / 0.01).astype(int)
+    sample_pair = np.repeat(np.arange(len(pairs)), num_step)
+    i_step = np.arange(len(sample_pair)) - np.repeat(np.cumsum(num_step) - num_step, num_step) + 1
+    unit_step = bone_ray[sample_pair] / (num_step[sample_pair, np.newaxis] + 1e-30)
+    bone_samples = pred_joints[pairs[sample_pair, 0]] + unit_step * i_step[:, np.newaxis]
+    bone_inside = inside_check_device(torch.from_numpy(bone_samples).to(device), vox_grid)
+    num_inside = np.bincount(sample_pair, weights=bone_inside.cpu().numpy(), minlength=len(pairs))
+    outside_proportion = num_inside / (num_step + 1e-10)
+    pair_attr = np.stack((dist, outside_proportion, np.ones_like(dist)), axis=1)
     pairs = torch.from_numpy(pairs).float()
     pair_attr = torch.from_numpy(pair_attr).float()
     pred_joints = torch.from_numpy(pred_joints).float()
@@ -221,6 +530,74 @@ def predict_joints(input_data, vox, joint_pred_net, threshold, bandwidth=None, m
     return input_data
 
 
+def primMST_symmetry_fast(graph, init_id, joints):
+    """
+    Same as primMST_symmetry: prim algorithm modified to generate a tree as symmetric as possible.
+    Keys, parents and the tree set are arrays, so that picking and relaxing vertices doesn't loop over all joints
+    :param graph: pairwise cost matrix
+    :param init_id: init node ID as root
+    :param joints: joint positions J*3
+    :return: parent of each joint, -1 for the root and -2 for unreached joints, and key of each joint
+    """
+    joint_mapping = {}
+    left_joint_ids = np.argwhere(joints[:, 0] < -2e-2).squeeze(1).tolist()
+    middle_joint_ids = np.argwhere(np.abs(joints[:, 0]) <= 2e-2).squeeze(1).tolist()
+    right_joint_ids = np.argwhere(joints[:, 0] > 2e-2).squeeze(1).tolist()
+    for i in range(len(left_joint_ids)):
+        joint_mapping[left_joint_ids[i]] = right_joint_ids[i]
+    for i in range(len(right_joint_ids)):
+        joint_mapping[right_joint_ids[i]] = left_joint_ids[i]
+
+    if init_id not in middle_joint_ids:
+        # find nearest joint in the middle to be root
+        if len(middle_joint_ids) > 0:
+            nearest_id = np.argmin(np.linalg.norm(joints[middle_joint_ids, :] - joints[init_id, :][np.newaxis, :], axis=1))
+            init_id = middle_joint_ids[nearest_id]
+
+    nV = graph.shape[0]
+    left_joint_ids, middle_joint_ids, right_joint_ids = set(left_joint_ids), set(middle_joint_ids), set(right_joint_ids)
+    # key values used to pick minimum weight edge in cut
+    key = np.full(nV, float(sys.maxsize))
+    parent = np.full(nV, -2)
+    mst_set = np.zeros(nV, dtype=bool)
+    # make key init_id so that this vertex is picked as first vertex
+    key[init_id] = 0
+    parent[init_id] = -1
+
+    while not mst_set.all():
+        # pick the minimum distance vertex from the set of vertices not yet processed
+        u = np.argmin(np.where(mst_set, np.inf, key))
+        u2 = None
+        if (u in left_joint_ids and parent[u] in left_joint_ids) or (u in right_joint_ids and parent[u] in right_joint_ids):
+            # add the mirrored joint to the mirrored parent
+            u2 = joint_mapping[u]
+            if not mst_set[u2]:
+                mst_set[u2] = True
+                parent[u2] = joint_mapping[parent[u]]
+                key[u2] = graph[u2, parent[u2]]
+        elif (u in left_joint_ids or u in right_joint_ids) and parent[u] in middle_joint_ids:
+            # add the mirrored joint to the same parent in the middle
+            u2 = joint_mapping[u]
+            if not mst_set[u2]:
+                mst_set[u2] = True
+                parent[u2] = parent[u]
+                key[u2] = graph[u2, parent[u2]]
+
+        mst_set[u] = True
+
+        # update the key of the adjacent vertices not yet in the tree, where the new edge is cheaper.
+        # graph[u] is non zero only for adjacent vertices of u
+        update = (graph[u] > 0) & ~mst_set & (key > graph[u])
+        key[update] = graph[u, update]
+        parent[update] = u
+        if u2 is not None:
+            update = (graph[u2] > 0) & ~mst_set & (key > graph[u2])
+            key[update] = graph[u2, update]
+            parent[update] = u2
+
+    return parent.tolist(), key.tolist()
+
+
 def predict_skeleton(input_data, vox, root_pred_net, bone_pred_net, mesh_filename=None):
     """
     Predict skeleton structure based on joints
@@ -231,12 +608,11 @@ def predict_skeleton(input_data, vox, root_pred_net, bone_pred_net, mesh_filenam
     :param mesh_filename: meshfilename for debugging
     :return: predicted skeleton structure
     """
-    root_id = getInitId(input_data, root_pred_net)
-    pred_joints = input_data.joints.data.cpu().numpy()
-
-    with torch.no_grad():
+    with network_inference():
+        root_id = getInitId(input_data, root_pred_net)
         connect_prob, _ = bone_pred_net(input_data, permute_joints=False)
-        connect_prob = torch.sigmoid(connect_prob)
+    connect_prob = torch.sigmoid(connect_prob.float())
+    pred_joints = input_data.joints.data.cpu().numpy()
     pair_idx = input_data.pairs.long().data.cpu().numpy()
     prob_matrix = np.zeros((len(input_data.joints), len(input_data.joints)))
     prob_matrix[pair_idx[:, 0], pair_idx[:, 1]] = connect_prob.data.cpu().numpy().squeeze()
@@ -245,7 +621,7 @@ def predict_skeleton(input_data, vox, root_pred_net, bone_pred_net, mesh_filenam
     cost_matrix = increase_cost_for_outside_bone(cost_matrix, pred_joints, vox)
 
     pred_skel = Info()
-    parent, key = primMST_symmetry(cost_matrix, root_id, pred_joints)
+    parent, key = primMST_symmetry_fast(cost_matrix, root_id, pred_joints)
     for i in range(len(parent)):
         if parent[i] == -1:
             pred_skel.root = TreeNode('root', tuple(pred_joints[i]))
@@ -256,6 +632,28 @@ def predict_skeleton(input_data, vox, root_pred_net, bone_pred_net, mesh_filenam
     return pred_skel
 
 
+def calc_pts2bone_visibility(mesh, origins, ends):
+    """
+    Check whether the surface points are visible by the internal bone samples, as in calc_pts2bone_visible_mat.
+    All rays are cast in one call to mesh.ray, which trimesh backs with embree when pyembree is installed
+    :param mesh: trimesh mesh
+    :param origins: surface points
+    :param ends: bone samples
+    :return: visibility of each surface point from its bone sample
+    """
+    origins = np.ascontiguousarray(origins)
+    ray_dir = np.ascontiguousarray(ends - origins)
+    locations, index_ray, _ = mesh.ray.intersects_location(origins, ray_dir + 1e-15)
+
+    # nearest hit of each ray, rays without hits reach their end
+    distance = np.linalg.norm(ray_dir, axis=1)
+    min_hit_distance = np.full(len(ray_dir), np.inf)
+    np.minimum.at(min_hit_distance, index_ray, np.linalg.norm(locations - origins[index_ray], axis=1))
+    no_hit = np.isinf(min_hit_distance)
+    min_hit_distance[no_hit] = distance[no_hit]
+    return np.abs(min_hit_distance - distance) < 1e-4
+
+
 def calc_geodesic_matrix(bones, mesh_v, surface_geodesic, mesh_filename, subsampling=False):
     """
     calculate volumetric geodesic distance from vertices to each bones
@@ -278,16 +676,14 @@ def calc_geodesic_matrix(bones, mesh_v, surface_geodesic, mesh_filename, subsamp
         mesh_trimesh = trimesh.load(mesh_filename)
         subsamples = mesh_v
     origins, ends, pts_bone_dist = pts2line(subsamples, bones)
-    pts_bone_visibility = calc_pts2bone_visible_mat(mesh_trimesh, origins, ends)
+    pts_bone_visibility = calc_pts2bone_visibility(mesh_trimesh, origins, ends)
     pts_bone_visibility = pts_bone_visibility.reshape(len(bones), len(subsamples)).transpose()
     pts_bone_dist = pts_bone_dist.reshape(len(bones), len(subsamples)).transpose()
     # remove visible points which are too far
-    for b in range(pts_bone_visibility.shape[1]):
-        visible_pts = np.argwhere(pts_bone_visibility[:, b] == 1).squeeze(1)
-        if len(visible_pts) == 0:
-            continue
-        threshold_b = np.percentile(pts_bone_dist[visible_pts, b], 15)
-        pts_bone_visibility[pts_bone_dist[:, b] > 1.3 * threshold_b, b] = False
+    has_visible = pts_bone_visibility.any(axis=0)
+    visible_dist = np.where(pts_bone_visibility[:, has_visible], pts_bone_dist[:, has_visible], np.nan)
+    threshold = np.nanpercentile(visible_dist, 15, axis=0)
+    pts_bone_visibility[:, has_visible] &= pts_bone_dist[:, has_visible] <= 1.3 * threshold
 
     visible_matrix = np.zeros(pts_bone_visibility.shape)
     visible_matrix[np.where(pts_bone_visibility == 1)] = pts_bone_dist[np.where(pts_bone_visibility == 1)]
@@ -297,16 +693,16 @@ def calc_geodesic_matrix(bones, mesh_v, surface_geodesic, mesh_filename, subsamp
         if len(visible_pts) == 0:
             visible_matrix[:, c] = pts_bone_dist[:, c]
             continue
-        for r in unvisible_pts:
-            dist1 = np.min(surface_geodesic[r, visible_pts])
-            nn_visible = visible_pts[np.argmin(surface_geodesic[r, visible_pts])]
-            if np.isinf(dist1):
-                visible_matrix[r, c] = 8.0 + pts_bone_dist[r, c]
-            else:
-                visible_matrix[r, c] = dist1 + visible_matrix[nn_visible, c]
+        # nearest visible point, along the surface, of all the unvisible points at once
+        unvisible_geodesic = surface_geodesic[np.ix_(unvisible_pts, visible_pts)]
+        nn_local = np.argmin(unvisible_geodesic, axis=1)
+        dist1 = unvisible_geodesic[np.arange(len(unvisible_pts)), nn_local]
+        nn_visible = visible_pts[nn_local]
+        visible_matrix[unvisible_pts, c] = np.where(np.isinf(dist1),
+                                                    8.0 + pts_bone_dist[unvisible_pts, c],
+                                                    dist1 + visible_matrix[nn_visible, c])
     if subsampling:
-        nn_dist = np.sum((mesh_v[:, np.newaxis, :] - subsamples[np.newaxis, ...]) ** 2, axis=2)
-        nn_ind = np.argmin(nn_dist, axis=1)
+        _, nn_ind = cKDTree(subsamples).query(mesh_v, k=1)
         visible_matrix = visible_matrix[nn_ind, :]
         os.remove(mesh_filename.replace(".obj", "_simplified.obj"))
     return visible_matrix
@@ -325,35 +721,26 @@ def calc_geodesic_matrix_2(bones, mesh_v, surface_geodesic, use_sampling=False,
     if use_sampling:
         mesh0 = MESH_NORMALIZED
         mesh0 = mesh0.simplify_quadric_decimation(decimation)
-
-        fo_simplified = tempfile.NamedTemporaryFile(suffix='_simplified.obj')
-        fo_simplified.close()
-        o3d.io.write_triangle_mesh(fo_simplified.name, mesh0)
-        mesh_trimesh = trimesh.load(fo_simplified.name)
-        os.unlink(fo_simplified.name)
+        mesh_trimesh = trimesh.Trimesh(vertices=np.asarray(mesh0.vertices), faces=np.asarray(mesh0.triangles),
+                                       process=False)
 
         subsamples_ids = np.random.choice(len(mesh_v), np.min((len(mesh_v), sampling)), replace=False)
         subsamples = mesh_v[subsamples_ids, :]
         surface_geodesic = surface_geodesic[subsamples_ids, :][:, subsamples_ids]
     else:
-        fo = tempfile.NamedTemporaryFile(suffix='.obj')
-        fo.close()
-        o3d.io.write_triangle_mesh(fo.name, MESH_NORMALIZED)
-        mesh_trimesh = trimesh.load(fo.name)
-        os.unlink(fo.name)
+        mesh_trimesh = trimesh.Trimesh(vertices=np.asarray(MESH_NORMALIZED.vertices),
+                                       faces=np.asarray(MESH_NORMALIZED.triangles), process=False)
         subsamples = mesh_v
 
     origins, ends, pts_bone_dist = pts2line(subsamples, bones)
-    pts_bone_visibility = calc_pts2bone_visible_mat(mesh_trimesh, origins, ends)
+    pts_bone_visibility = calc_pts2bone_visibility(mesh_trimesh, origins, ends)
     pts_bone_visibility = pts_bone_visibility.reshape(len(bones), len(subsamples)).transpose()
     pts_bone_dist = pts_bone_dist.reshape(len(bones), len(subsamples)).transpose()
     # remove visible points which are too far
-    for b in range(pts_bone_visibility.shape[1]):
-        visible_pts = np.argwhere(pts_bone_visibility[:, b] == 1).squeeze(1)
-        if len(visible_pts) == 0:
-            continue
-        threshold_b = np.percentile(pts_bone_dist[visible_pts, b], 15)
-        pts_bone_visibility[pts_bone_dist[:, b] > 1.3 * threshold_b, b] = False
+    has_visible = pts_bone_visibility.any(axis=0)
+    visible_dist = np.where(pts_bone_visibility[:, has_visible], pts_bone_dist[:, has_visible], np.nan)
+    threshold = np.nanpercentile(visible_dist, 15, axis=0)
+    pts_bone_visibility[:, has_visible] &= pts_bone_dist[:, has_visible] <= 1.3 * threshold
 
     visible_matrix = np.zeros(pts_bone_visibility.shape)
     visible_matrix[np.where(pts_bone_visibility == 1)] = pts_bone_dist[np.where(pts_bone_visibility == 1)]
@@ -363,20 +750,71 @@ def calc_geodesic_matrix_2(bones, mesh_v, surface_geodesic, use_sampling=False,
         if len(visible_pts) == 0:
             visible_matrix[:, c] = pts_bone_dist[:, c]
             continue
-        for r in unvisible_pts:
-            dist1 = np.min(surface_geodesic[r, visible_pts])
-            nn_visible = visible_pts[np.argmin(surface_geodesic[r, visible_pts])]
-            if np.isinf(dist1):
-                visible_matrix[r, c] = 8.0 + pts_bone_dist[r, c]
-            else:
-                visible_matrix[r, c] = dist1 + visible_matrix[nn_visible, c]
+        # nearest visible point, along the surface, of all the unvisible points at once
+        unvisible_geodesic = surface_geodesic[np.ix_(unvisible_pts, visible_pts)]
+        nn_local = np.argmin(unvisible_geodesic, axis=1)
+        dist1 = unvisible_geodesic[np.arange(len(unvisible_pts)), nn_local]
+        nn_visible = visible_pts[nn_local]
+        visible_matrix[unvisible_pts, c] = np.where(np.isinf(dist1),
+                                                    8.0 + pts_bone_dist[unvisible_pts, c],
+                                                    dist1 + visible_matrix[nn_visible, c])
     if use_sampling:
-        nn_dist = np.sum((mesh_v[:, np.newaxis, :] - subsamples[np.newaxis, ...]) ** 2, axis=2)
-        nn_ind = np.argmin(nn_dist, axis=1)
+        _, nn_ind = cKDTree(subsamples).query(mesh_v, k=1)
         visible_matrix = visible_matrix[nn_ind, :]
     return visible_matrix
 
 
+def run_skinning_net(skin_pred_net, input_data):
+    """
+    Run the skinning network. On cuda the forward is captured in a CUDA graph,
+    which is replayed when the next input has the same shapes.
+    Only the last graph is kept, its memory pool stays allocated until a mesh of different size is captured
+    or clear() is called
+    :param skin_pred_net: network to predict skinning weights
+    :param input_data: wrapped input data, with skin_input
+    :return: raw skinning prediction
+    """
+    if device.type != 'cuda' or not hasattr(torch.cuda, 'graph') or (id(skin_pred_net),) in SKIN_GRAPHS:
+        # no graphs on cpu or before torch 1.10, or capture of this network failed already
+        with network_inference():
+            return skin_pred_net(input_data)
+
+    # only the members read by SKINNET, the joints and pairs change with bandwidth and threshold
+    inputs = [(key, input_data[key]) for key in SKIN_INPUTS]
+    graph_key = (id(skin_pred_net),) + tuple((key, tuple(value.shape), value.dtype) for key, value in inputs)
+
+    if graph_key not in SKIN_GRAPHS:
+        # a graph holds on to its memory pool, release the previous one first
+        SKIN_GRAPHS.clear()
+        static_data = Data(**{key: value.clone() for key, value in inputs})
+        try:
+            # warm up on a side stream before capturing
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream), network_inference():
+                for _ in range(3):
+                    skin_pred_net(static_data)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph), network_inference():
+                static_output = skin_pred_net(static_data)
+        except RuntimeError as e:
+            # capture fails on ops that synchronize with the host, whatever the shapes: don't try again
+            print("     skinning network not captured, running eagerly: {0}".format(e))
+            SKIN_GRAPHS[(id(skin_pred_net),)] = None
+            with network_inference():
+                return skin_pred_net(input_data)
+
+        SKIN_GRAPHS[graph_key] = skin_pred_net, static_data, graph, static_output
+
+    _, static_data, graph, static_output = SKIN_GRAPHS[graph_key]
+    for key, value in inputs:
+        static_data[key].copy_(value)
+    graph.replay()
+    return static_output.clone()
+
+
 def predict_skinning(input_data, pred_skel, skin_pred_net, surface_geodesic, subsampling=False, decimation=3000, sampling=1500):
     """
     predict skinning
@@ -394,50 +832,35 @@ def predict_skinning(input_data, pred_skel, skin_pred_net, surface_geodesic, sub
     print("     calculating volumetric geodesic distance from vertices to bone. This step takes some time...")
 
     geo_dist = calc_geodesic_matrix_2(bones, mesh_v, surface_geodesic, use_sampling=subsampling, decimation=decimation, sampling=sampling)
-    input_samples = []  # joint_pos (x, y, z), (bone_id, 1/D)*5
-    loss_mask = []
-    skin_nn = []
-    for v_id in range(len(mesh_v)):
-        geo_dist_v = geo_dist[v_id]
-        bone_id_near_to_far = np.argsort(geo_dist_v)
-        this_sample = []
-        this_nn = []
-        this_mask = []
-        for i in range(num_nearest_bone):
-            if i >= len(bones):
-                this_sample += bones[bone_id_near_to_far[0]].tolist()
-                this_sample.append(1.0 / (geo_dist_v[bone_id_near_to_far[0]] + 1e-10))
-                this_sample.append(bone_isleaf[bone_id_near_to_far[0]])
-                this_nn.append(0)
-                this_mask.append(0)
-            else:
-                skel_bone_id = bone_id_near_to_far[i]
-                this_sample += bones[skel_bone_id].tolist()
-                this_sample.append(1.0 / (geo_dist_v[skel_bone_id] + 1e-10))
-                this_sample.append(bone_isleaf[skel_bone_id])
-                this_nn.append(skel_bone_id)
-                this_mask.append(1)
-        input_samples.append(np.array(this_sample)[np.newaxis, :])
-        skin_nn.append(np.array(this_nn)[np.newaxis, :])
-        loss_mask.append(np.array(this_mask)[np.newaxis, :])
-
-    skin_input = np.concatenate(input_samples, axis=0)
-    loss_mask = np.concatenate(loss_mask, axis=0)
-    skin_nn = np.concatenate(skin_nn, axis=0)
-    skin_input = torch.from_numpy(skin_input).float()
-    input_data.skin_input = skin_input
+    # joint_pos (x, y, z), (bone_id, 1/D)*5 for the nearest bones of each vertex, sorted from near to far.
+    # Samples are gathered on the device, only the bone ids come back for the final scatter
+    num_valid_bone = min(num_nearest_bone, len(bones))
+    geo_dist_t = torch.from_numpy(geo_dist).to(device)
+    nn_dist, sample_nn = torch.topk(geo_dist_t, k=num_valid_bone, dim=1, largest=False)
+    skin_nn = sample_nn.cpu().numpy()
+    loss_mask = np.ones((len(mesh_v), num_nearest_bone), dtype=int)
+    if num_valid_bone < num_nearest_bone:
+        # not enough bones: fill the remaining samples with the nearest bone and mask them out
+        num_pad = num_nearest_bone - num_valid_bone
+        sample_nn = torch.cat((sample_nn, sample_nn[:, :1].expand(-1, num_pad)), dim=1)
+        nn_dist = torch.cat((nn_dist, nn_dist[:, :1].expand(-1, num_pad)), dim=1)
+        skin_nn = np.concatenate((skin_nn, np.zeros((len(mesh_v), num_pad), dtype=int)), axis=1)
+        loss_mask[:, num_valid_bone:] = 0
+
+    bones_t = torch.from_numpy(bones).to(device)
+    isleaf_t = torch.as_tensor(np.asarray(bone_isleaf), dtype=bones_t.dtype, device=device)
+    skin_input = torch.cat((bones_t[sample_nn], (1.0 / (nn_dist + 1e-10)).unsqueeze(2),
+                            isleaf_t[sample_nn].unsqueeze(2)), dim=2)
+    input_data.skin_input = skin_input.reshape(len(mesh_v), -1).float()
     input_data.to(device)
 
-    skin_pred = skin_pred_net(input_data)
-    skin_pred = torch.softmax(skin_pred, dim=1)
+    skin_pred = run_skinning_net(skin_pred_net, input_data)
+    skin_pred = torch.softmax(skin_pred.float(), dim=1)
     skin_pred = skin_pred.data.cpu().numpy()
     skin_pred = skin_pred * loss_mask
 
-    skin_nn = skin_nn[:, 0:num_nearest_bone]
     skin_pred_full = np.zeros((len(skin_pred), len(bone_names)))
-    for v in range(len(skin_pred)):
-        for nn_id in range(len(skin_nn[v, :])):
-            skin_pred_full[v, skin_nn[v, nn_id]] = skin_pred[v, nn_id]
+    np.put_along_axis(skin_pred_full, skin_nn, skin_pred, axis=1)
     print("     filtering skinning prediction")
     tpl_e = input_data.tpl_edge_index.data.cpu().numpy()
     skin_pred_full = post_filter(skin_pred_full, tpl_e, num_ring=1)
@@ -447,22 +870,36 @@ def predict_skinning(input_data, pred_skel, skin_pred_net, surface_geodesic, sub
     return skel_res
 
 
-def predict_rig(mesh_obj, bandwidth, threshold, downsample_skinning=True, decimation=3000, sampling=1500):
-    print("predicting rig")
-    # downsample_skinning is used to speed up the calculation of volumetric geodesic distance
-    # and to save cpu memory in skinning calculation.
-    # Change to False to be more accurate but less efficient.
+def compile_network(net):
+    """
+    Compile network with TorchScript
+    :param net: network in eval mode, with weights loaded
+    :return: compiled network, or the network itself if it can't be scripted
+    """
+    try:
+        return torch.jit.script(net)
+    except Exception as e:
+        print("     {0} not compiled, running eagerly: {1}".format(type(net).__name__, e))
+        return net
 
-    # load all weights
-    print("loading all networks...")
 
-    model_dir = bpy.context.preferences.addons[__package__].preferences.model_path
+def load_networks(model_dir):
+    """
+    Load and compile all networks. They are kept in NETWORKS for the next predictions
+    :param model_dir: folder of the RigNet checkpoints
+    :return: joint, root, bone and skinning networks
+    """
+    if model_dir in NETWORKS:
+        return NETWORKS[model_dir]
+
+    print("loading all networks...")
 
     jointNet = JOINTNET()
     jointNet.to(device)
     jointNet.eval()
     jointNet_checkpoint = torch.load(os.path.join(model_dir, 'gcn_meanshift/model_best.pth.tar'))
     jointNet.load_state_dict(jointNet_checkpoint['state_dict'])
+    jointNet = compile_network(jointNet)
     print("     joint prediction network loaded.")
 
     rootNet = ROOTNET()
@@ -470,6 +907,7 @@ def predict_rig(mesh_obj, bandwidth, threshold, downsample_skinning=True, decima
     rootNet.eval()
     rootNet_checkpoint = torch.load(os.path.join(model_dir, 'rootnet/model_best.pth.tar'))
     rootNet.load_state_dict(rootNet_checkpoint['state_dict'])
+    rootNet = compile_network(rootNet)
     print("     root prediction network loaded.")
 
     boneNet = BONENET()
@@ -477,6 +915,7 @@ def predict_rig(mesh_obj, bandwidth, threshold, downsample_skinning=True, decima
     boneNet.eval()
     boneNet_checkpoint = torch.load(os.path.join(model_dir, 'bonenet/model_best.pth.tar'))
     boneNet.load_state_dict(boneNet_checkpoint['state_dict'])
+    boneNet = compile_network(boneNet)
     print("     connection prediction network loaded.")
 
     skinNet = SKINNET(nearest_bone=5, use_Dg=True, use_Lf=True)
@@ -484,17 +923,50 @@ def predict_rig(mesh_obj, bandwidth, threshold, downsample_skinning=True, decima
     skinNet.load_state_dict(skinNet_checkpoint['state_dict'])
     skinNet.to(device)
     skinNet.eval()
+    skinNet = compile_network(skinNet)
     print("     skinning prediction network loaded.")
 
-    data, vox, surface_geodesic, translation_normalize, scale_normalize = create_single_data(mesh_obj)
-    data.to(device)
+    # only keep the networks of the last model folder on the device
+    NETWORKS.clear()
+    SKIN_GRAPHS.clear()
+    NETWORKS[model_dir] = jointNet, rootNet, boneNet, skinNet
+    return NETWORKS[model_dir]
+
+
+def predict_rig(mesh_obj, bandwidth, threshold, downsample_skinning=True, decimation=3000, sampling=1500):
+    print("predicting rig")
+    # downsample_skinning is used to speed up the calculation of volumetric geodesic distance
+    # and to save cpu memory in skinning calculation.
+    # Change to False to be more accurate but less efficient.
+
+    if device.type == 'cuda' and hasattr(torch.backends.cuda, 'matmul'):
+        # let float32 matmuls and convolutions run on tensor cores
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    prefs = bpy.context.preferences.addons[__package__].preferences
+    check_paths(prefs.rignet_path, prefs.model_path)
+    mesh_v, mesh_f = extract_mesh(mesh_obj)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # voxelization and geodesic distances don't depend on the networks, compute them while loading weights
+        mesh_future = executor.submit(create_single_data, mesh_v, mesh_f, prefs.rignet_path, prefs.cache_path)
+
+        # load all weights
+        jointNet, rootNet, boneNet, skinNet = load_networks(prefs.model_path)
+
+        data, vox, surface_geodesic, translation_normalize, scale_normalize = mesh_future.result()
+    data.to(device, non_blocking=True)
 
     print("predicting joints")
     data = predict_joints(data, vox, jointNet, threshold, bandwidth=bandwidth)
+    # release the activations of each stage before the next network runs
+    torch.cuda.empty_cache()
 
     data.to(device)
     print("predicting connectivity")
     pred_skeleton = predict_skeleton(data, vox, rootNet, boneNet)
+    torch.cuda.empty_cache()
     # pred_skeleton.normalize(scale_normalize, -translation_normalize)
 
     print("predicting skinning")
@@ -517,4 +989,6 @@ def predict_rig(mesh_obj, bandwidth, threshold, downsample_skinning=True, decima
 
 
 def clear():
+    SKIN_GRAPHS.clear()
+    NETWORKS.clear()
     torch.cuda.empty_cache()